@@ -1,22 +1,31 @@
+import atexit
 import datetime
+import functools
 import json
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from pathlib import Path
-from pprint import pprint
 from typing import Optional
 
 import click
 from dotenv import load_dotenv
 from loguru import logger
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 import tomli
-from tinydb import TinyDB, Query
-
-
-load_dotenv()
+from urllib3.util.retry import Retry
 
 
 AVAILABLE_COMMANDS = ["backup", "now_playing", "compile_unplaylisted"]
+COMMAND_CHOICE = click.Choice(AVAILABLE_COMMANDS)
+
+# how many page requests to have in flight at once when paginating
+MAX_WORKERS = 8
 
 
 scopes = [
@@ -26,37 +35,93 @@ scopes = [
 ]
 
 scope = " ".join(scopes)
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope, open_browser=False))
+
+# one long-lived session so every API call reuses pooled keep-alive
+# connections instead of paying a TCP + TLS handshake per request
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        # backup_all_playlists fetches MAX_WORKERS playlists at once and
+        # each of those paginates on its own MAX_WORKERS pool, so size for
+        # the worst case or urllib3 discards the overflow connections and
+        # re-pays the TLS handshakes the shared session exists to avoid
+        pool_maxsize=MAX_WORKERS * MAX_WORKERS,
+        max_retries=Retry(
+            total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]
+        ),
+    ),
+)
+atexit.register(session.close)
+
+
+@functools.lru_cache(maxsize=1)
+def get_sp() -> spotipy.Spotify:
+    """ The Spotify client, built on first use.
+
+    Constructing SpotifyOAuth requires credentials, so deferring it keeps
+    importing the module (and e.g. `--help`) from needing any configured.
+    """
+    load_dotenv()
+    return spotipy.Spotify(
+        auth_manager=SpotifyOAuth(scope=scope, open_browser=False),
+        requests_session=session,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_current_user_id() -> str:
+    """ The current user's id; cached since it cannot change within a run. """
+    return get_sp().me()["id"]
+
+
+def _get_all_pages(get_page, limit: int) -> list:
+    """ Collect every item from a paginated endpoint.
+
+    `get_page` takes an offset and returns one response page. The first
+    request tells us the total, so the remaining pages can be fetched
+    concurrently since their offsets are known up front.
+    """
+    first = get_page(0)
+    pages = [first]
+    offsets = range(limit, first["total"], limit)
+    if offsets:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            pages.extend(executor.map(get_page, offsets))
+    return list(chain.from_iterable(page["items"] for page in pages))
 
 
 def get_saved_tracks():
     """ Requires scope: user-library-read"""
     logger.debug("Getting saved tracks")
 
+    # 50 is the max limit for saved tracks
     MAX_LIMIT = 50
-    tracks = []
-    offset = 0
-    while True:
-        logger.debug(f"Getting saved tracks offset: {offset}")
-        response = sp.current_user_saved_tracks(limit=MAX_LIMIT, offset=offset)
-        tracks.extend(response["items"])
-        offset += MAX_LIMIT
-        if response["next"] is None:
-            break
 
-    return tracks
+    def get_page(offset: int):
+        # pass the offset as a format arg so loguru only interpolates it
+        # when the DEBUG level is actually enabled
+        logger.debug("Getting saved tracks offset: {}", offset)
+        return get_sp().current_user_saved_tracks(limit=MAX_LIMIT, offset=offset)
+
+    return _get_all_pages(get_page, MAX_LIMIT)
 
 
 def get_now_playing(full: bool = True):
     """ Requires scope: user-read-currently-playing"""
-    currently_playing = sp.currently_playing()
+    # the currently-playing endpoint has no `fields` parameter (unlike the
+    # playlist endpoints), so the full response is fetched either way and
+    # the short form just projects it client-side
+    currently_playing = get_sp().currently_playing()
     if not full:
+        item = currently_playing["item"]
         return dict(
-            title=currently_playing["item"]["name"],
-            artists=[artist["name"] for artist in currently_playing["item"]["artists"]],
+            title=item["name"],
+            artists=[artist["name"] for artist in item["artists"]],
             # artists_string = ", ".join([artist["name"] for artist in artists]),
-            # album_art_url = currently_playing["item"]["album"]["images"][-1]["url"],
-            album_name=currently_playing["item"]["album"]["name"],
+            # album_art_url = item["album"]["images"][-1]["url"],
+            album_name=item["album"]["name"],
         )
     return currently_playing
 
@@ -69,23 +134,18 @@ def get_all_playlists():
     # 50 is the max limit for playlists
     MAX_LIMIT = 50
 
-    playlists = []
-    offset = 0
-    while True:
-        response = sp.current_user_playlists(limit=MAX_LIMIT, offset=offset)
-        playlists.extend(response["items"])
-        offset += MAX_LIMIT
-        if response["next"] is None:
-            break
+    def get_page(offset: int):
+        logger.debug("Getting playlists offset: {}", offset)
+        return get_sp().current_user_playlists(limit=MAX_LIMIT, offset=offset)
 
-    return playlists
+    return _get_all_pages(get_page, MAX_LIMIT)
 
 
 def get_playlist(playlist_id: str):
     """ Get a playlist info, along with all the tracks. """
-    logger.debug(f"Getting playlist: {playlist_id}")
+    logger.debug("Getting playlist: {}", playlist_id)
 
-    playlist_info = sp.playlist(playlist_id=playlist_id)
+    playlist_info = get_sp().playlist(playlist_id=playlist_id)
 
     if playlist_info["tracks"]["next"] is not None:
         # the first call did not return all the tracks
@@ -99,18 +159,13 @@ def get_playlist_tracks(playlist_id: str):
     """ Get all the tracks for a playlist. """
     MAX_LIMIT = 100
 
-    tracks = []
-    offset = 0
-    while True:
-        response = sp.playlist_items(
+    def get_page(offset: int):
+        logger.debug("Getting playlist {} tracks offset: {}", playlist_id, offset)
+        return get_sp().playlist_items(
             playlist_id=playlist_id, limit=MAX_LIMIT, offset=offset
         )
-        tracks.extend(response["items"])
-        offset += MAX_LIMIT
-        if response["next"] is None:
-            break
 
-    return tracks
+    return _get_all_pages(get_page, MAX_LIMIT)
 
 
 def backup(only_mine: bool = False):
@@ -127,19 +182,74 @@ def backup_all_playlists(only_mine: bool = False, backup_time: Optional[datetime
     playlists = get_all_playlists()
     logger.info(f"Backing up {len(playlists)} playlists")
 
+    db = get_db()
+    previous = _last_playlist_backups(db)
+
+    full_playlists = []
+    to_fetch = []
     for playlist in playlists:
-        if only_mine and playlist["owner"]["id"] != sp.me()["id"]:
+        if only_mine and playlist["owner"]["id"] != get_current_user_id():
             continue
-        logger.info(f"Backing up playlist: {playlist['name']} id: {playlist['id']}")
-        backup_playlist(playlist_id=playlist["id"], backup_time=backup_time)
+        # a playlist's snapshot_id changes whenever its contents do, so an
+        # unchanged snapshot means the stored document is still current and
+        # the tracks do not need to be fetched again
+        last = previous.get(playlist["id"])
+        if last is not None and last.get("snapshot_id") == playlist["snapshot_id"]:
+            logger.info(f"Playlist unchanged, reusing backup: {playlist['name']} id: {playlist['id']}")
+            full_playlists.append(last)
+        else:
+            logger.info(f"Backing up playlist: {playlist['name']} id: {playlist['id']}")
+            to_fetch.append(playlist["id"])
+
+    # fetch the changed playlists concurrently; each fetch is independent
+    # and spends almost all its time waiting on the network
+    if to_fetch:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            full_playlists.extend(executor.map(get_playlist, to_fetch))
+
+    for full_playlist in full_playlists:
+        full_playlist["backup_time"] = backup_time
+
+    # write every playlist in one transaction rather than one commit
+    # (and one fsync) per playlist
+    _insert_docs(
+        db,
+        "playlist",
+        backup_time,
+        [(playlist["id"], playlist) for playlist in full_playlists],
+    )
 
 
 def backup_playlist(playlist_id: str, backup_time: datetime.datetime):
     playlist = get_playlist(playlist_id=playlist_id)
-    db = get_db()
-    playlist_table = db.table("playlists")
     playlist["backup_time"] = backup_time
-    playlist_table.insert(playlist)
+    _insert_docs(get_db(), "playlist", backup_time, [(playlist["id"], playlist)])
+
+
+def _last_playlist_backups(db: sqlite3.Connection) -> dict:
+    """ Map playlist id -> stored document from the most recent playlist backup. """
+    rows = db.execute(
+        """
+        SELECT doc_id, json FROM docs
+        WHERE kind = 'playlist'
+          AND backup_time = (SELECT MAX(backup_time) FROM docs WHERE kind = 'playlist')
+        """
+    )
+    return {doc_id: orjson.loads(doc) for doc_id, doc in rows}
+
+
+def _insert_docs(db: sqlite3.Connection, kind: str, backup_time: str, docs: list):
+    """ Insert documents for one backup in a single transaction. """
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)",
+            (
+                # orjson serializes several times faster than the stdlib;
+                # decode so the column stays TEXT
+                (backup_time, kind, doc_id, orjson.dumps(doc).decode())
+                for doc_id, doc in docs
+            ),
+        )
 
 
 def backup_saved_tracks(backup_time: Optional[datetime.datetime] = None):
@@ -148,20 +258,33 @@ def backup_saved_tracks(backup_time: Optional[datetime.datetime] = None):
     logger.info("Backing up saved tracks")
     tracks = get_saved_tracks()
     logger.info(f"Found {len(tracks)} saved tracks")
-    db = get_db()
 
-    saved_tracks_table = db.table("saved_tracks")
     for i in range(len(tracks)):
         tracks[i]["backup_time"] = backup_time
-    
-    saved_tracks_table.insert_multiple(tracks)
+
+    _insert_docs(
+        get_db(),
+        "saved",
+        backup_time,
+        [(track["track"]["id"], track) for track in tracks],
+    )
+
+
+def _chunked(items: list, size: int):
+    """ Yield successive lists of at most `size` items. """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 
 def get_most_recent_backup_time() -> datetime.datetime:
     db = get_db()
-    saved_tracks_table = db.table("saved_tracks")
-    backup_time = max(track["backup_time"] for track in saved_tracks_table.search(
-        Query().backup_time.exists()))
+    # MAX over the (kind, backup_time) index is a single b-tree seek,
+    # not a scan over every stored row
+    (backup_time,) = db.execute(
+        "SELECT MAX(backup_time) FROM docs WHERE kind = 'saved'"
+    ).fetchone()
+    if backup_time is None:
+        raise ValueError("No saved track backups found")
     return datetime.datetime.fromisoformat(backup_time)
 
 
@@ -175,51 +298,65 @@ def make_playlist_with_liked_but_not_playlisted_tracks():
     for the saved tracks.
     """
     db = get_db()
-    saved_tracks_table = db.table("saved_tracks")
-    playlists_table = db.table("playlists")
 
     # get the latest backup time
     backup_time = get_most_recent_backup_time().isoformat()
 
-    # get all the saved tracks and playlists from that backup time
-    saved_tracks = saved_tracks_table.search(Query().backup_time == backup_time)
-    playlists = playlists_table.search(Query().backup_time == backup_time)
+    # only the track ids are consumed here, so extract them inside SQLite
+    # with json_extract instead of deserializing every full document
 
     # get all the track ids from the playlists
-    playlist_track_ids = set()
-    for playlist in playlists:
-        for track in playlist["tracks"]["items"]:
-            playlist_track_ids.add(track["track"]["id"])
+    playlist_track_ids = {
+        row[0]
+        for row in db.execute(
+            """
+            SELECT json_extract(item.value, '$.track.id')
+            FROM docs, json_each(docs.json, '$.tracks.items') AS item
+            WHERE kind = 'playlist' AND backup_time = ?
+            """,
+            (backup_time,),
+        )
+    }
 
     # get all the track ids from the saved tracks
-    saved_track_ids = set()
-    for track in saved_tracks:
-        saved_track_ids.add(track["track"]["id"])
+    saved_track_ids = {
+        row[0]
+        for row in db.execute(
+            """
+            SELECT json_extract(json, '$.track.id')
+            FROM docs WHERE kind = 'saved' AND backup_time = ?
+            """,
+            (backup_time,),
+        )
+    }
 
     # get the track ids that are in the saved tracks, but not in the playlists
-    track_ids_to_add = saved_track_ids - playlist_track_ids
+    track_ids_to_add = list(saved_track_ids - playlist_track_ids)
 
-    # get the track info for the tracks to add
-    tracks_to_add_uri = []
-    tracks_to_add = []
-    for track_id in track_ids_to_add:
-        track = sp.track(track_id)
-        tracks_to_add_uri.append(track["uri"])
-        tracks_to_add.append(track)
+    # track uris are just the ids with a fixed prefix, no lookup needed
+    tracks_to_add_uri = [f"spotify:track:{track_id}" for track_id in track_ids_to_add]
+
+    # get the track info for the tracks to add, 50 ids per request
+    tracks_to_add = [
+        track
+        for chunk in _chunked(track_ids_to_add, 50)
+        for track in get_sp().tracks(chunk)["tracks"]
+    ]
 
     # create the playlist
     playlist_name = f"Liked but not playlisted {backup_time}"
-    playlist = sp.user_playlist_create(user=sp.me()["id"], name=playlist_name)
+    playlist = get_sp().user_playlist_create(user=get_current_user_id(), name=playlist_name)
 
-    # add the tracks to the playlist
-    sp.playlist_add_items(playlist_id=playlist["id"], items=tracks_to_add_uri)
+    # add the tracks to the playlist, 100 uris per request
+    for chunk in _chunked(tracks_to_add_uri, 100):
+        get_sp().playlist_add_items(playlist_id=playlist["id"], items=chunk)
     return tracks_to_add
 
 
 def main(
     command,
     json_path: Optional[str] = None,
-    print: bool = False,
+    print_result: bool = False,
     full: Optional[bool] = True,
     overwrite: bool = False,
 ):
@@ -232,34 +369,68 @@ def main(
     else:
         raise ValueError(f"Unknown command: {command}")
 
-    if print:
-        pprint(result)
+    if print_result:
+        # orjson renders the result in one pass, far faster than pprint's
+        # recursive formatting on large backup payloads
+        sys.stdout.buffer.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+        sys.stdout.buffer.write(b"\n")
 
     if json_path is not None:
         json_path = Path(json_path)
         if json_path.is_file() and not overwrite:
             raise FileExistsError(f"File already exists: {json_path}")
         json_path.parent.mkdir(parents=True, exist_ok=True)
-        json_path.write_text(json.dumps(result, indent=4))
+        # stream straight to the file instead of materializing the whole
+        # indented string in memory first
+        with json_path.open("w") as f:
+            json.dump(result, f, indent=4)
 
     return result
 
 
+@functools.lru_cache(maxsize=1)
 def get_config() -> dict:
     return tomli.loads((Path(__file__).parent / "config.toml").read_text())
 
 
-def get_db() -> TinyDB:
+@functools.lru_cache(maxsize=1)
+def get_db() -> sqlite3.Connection:
+    """ The backup database connection, opened once per process.
+
+    Caching the connection means the schema setup runs once and every
+    caller shares the same page cache instead of reopening the file.
+    """
     config = get_config()
-    db = TinyDB(config["db_file"])
+    db = sqlite3.connect(config["db_file"])
+    atexit.register(db.close)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS docs (
+            backup_time TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            json TEXT NOT NULL,
+            PRIMARY KEY (backup_time, kind, doc_id)
+        )
+        """
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_docs_kind_time ON docs (kind, backup_time)"
+    )
     return db
 
 
 @click.command()
-@click.argument("command", type=click.Choice(AVAILABLE_COMMANDS))
+@click.argument("command", type=COMMAND_CHOICE)
 @click.option("--json-file", type=click.Path())
 @click.option(
-    "--print", is_flag=True, help="Print the result to the console", default=False
+    "--print",
+    "print_result",
+    is_flag=True,
+    help="Print the result to the console",
+    default=False,
 )
 @click.option(
     "--full/--short",
@@ -273,8 +444,8 @@ def get_db() -> TinyDB:
     help="Overwrite existing files",
     default=False,
 )
-def cli(command: str, json_file: str, print: bool, full: bool, overwrite: bool):
-    return main(command, json_file, print, full=full, overwrite=overwrite)
+def cli(command: str, json_file: str, print_result: bool, full: bool, overwrite: bool):
+    return main(command, json_file, print_result, full=full, overwrite=overwrite)
 
 
 if __name__ == "__main__":